@@ -1,18 +1,26 @@
 import asyncio
-import json
+import hashlib
+import html
 import logging
 import os
+import random
+import time
+from contextlib import asynccontextmanager
+from functools import lru_cache
 from pathlib import Path
 
 from aiogram import Bot, Dispatcher, executor, types
 from aiogram.contrib.fsm_storage.memory import MemoryStorage
 from aiogram.contrib.middlewares.i18n import I18nMiddleware
 from aiogram.dispatcher import FSMContext
+import httpx
+import orjson
 from dotenv import load_dotenv
 from aiogram.dispatcher.filters.state import State, StatesGroup
+from aiogram.dispatcher.storage import FSMContextProxy
 from aiogram.types import (InlineKeyboardButton, InlineKeyboardMarkup,
                            ReplyKeyboardRemove)
-from groq import Groq
+from groq import AsyncGroq, RateLimitError
 
 # --- Конфигурация ---
 try:
@@ -27,18 +35,65 @@ if not all([BOT_TOKEN, ADMIN_ID, GROQ_API_KEY]):
         "One or more required configurations (BOT_TOKEN, ADMIN_ID, GROQ_API_KEY) are missing."
     )
 
+# Redis включается только явно заданным REDIS_HOST; без него FSM живет в памяти одного процесса
+REDIS_HOST = os.getenv("REDIS_HOST")
+REDIS_PORT = int(os.getenv("REDIS_PORT", 6379))
+REDIS_DB = int(os.getenv("REDIS_DB", 0))
+
+# Если WEBHOOK_HOST задан, бот принимает обновления через вебхук, иначе — long polling.
+# TLS терминируется на reverse proxy (Caddy/Nginx) перед WEBAPP_HOST:WEBAPP_PORT.
+# Прокси должен передавать X-Forwarded-For: по нему проверяется, что запрос пришел от Telegram.
+# Путь по умолчанию выводится из токена, чтобы его нельзя было угадать и подделать обновления.
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST")
+WEBHOOK_PATH = os.getenv(
+    "WEBHOOK_PATH", f"/webhook/{hashlib.sha256(BOT_TOKEN.encode()).hexdigest()[:32]}"
+)
+WEBHOOK_URL = f"{WEBHOOK_HOST}{WEBHOOK_PATH}" if WEBHOOK_HOST else None
+WEBAPP_HOST = os.getenv("WEBAPP_HOST", "0.0.0.0")
+WEBAPP_PORT = int(os.getenv("WEBAPP_PORT", 8080))
+
 # --- Настройка ---
 logging.basicConfig(level=logging.INFO)
 
+try:
+    import uvloop
+    uvloop.install()
+except ImportError:
+    # uvloop недоступен на Windows — остаемся на стандартном цикле событий
+    pass
+
 bot = Bot(token=BOT_TOKEN)
-storage = MemoryStorage()
+# FSM хранится в Redis, чтобы переживать рестарты и запускать несколько воркеров.
+# В redis.conf отключите `appendfsync always` (используйте `everysec` или только RDB),
+# иначе каждый update_data будет ждать сброса на диск.
+if REDIS_HOST:
+    try:
+        # RedisStorage2 из aiogram 2 требует aioredis, который не импортируется на Python 3.11+
+        from aiogram.contrib.fsm_storage.redis import RedisStorage2
+    except (ImportError, TypeError) as e:
+        raise RuntimeError(
+            "REDIS_HOST is set, but Redis storage is unavailable (aioredis requires Python <= 3.10)."
+        ) from e
+    storage = RedisStorage2(host=REDIS_HOST, port=REDIS_PORT, db=REDIS_DB, prefix='smoky_fsm')
+else:
+    storage = MemoryStorage()
 dp = Dispatcher(bot, storage=storage)
 
 # --- i18n (Интернационализация) ---
 BASE_DIR = Path(__file__).resolve().parent
 locales_path = os.path.join(BASE_DIR, 'locales')
 i18n = I18nMiddleware('messages', locales_path, default='ru')
-_ = i18n.gettext
+
+# Кэш переводов по (локаль, ключ): словарь вместо обхода каталога на каждый вызов
+_translations: dict[tuple[str, str], str] = {}
+
+def _(key: str) -> str:
+    locale = i18n.ctx_locale.get()
+    text = _translations.get((locale, key))
+    if text is None:
+        text = _translations[(locale, key)] = i18n.gettext(key, locale=locale)
+    return text
+
 dp.middleware.setup(i18n)
 
 # --- FSM Состояния ---
@@ -47,12 +102,109 @@ class Conversation(StatesGroup):
     active = State()
     confirmation = State()
 
-# --- Клиент Groq и AI ---
-client = Groq(api_key=GROQ_API_KEY)
+# --- Клавиатуры и шаблоны ---
+# Собираются один раз при импорте для каждой локали, чтобы не пересоздавать
+# кнопки и не ходить в каталог переводов на каждом сообщении.
+LANGUAGES = ('ru', 'en', 'pl')
+I18N_KEYS = (
+    'welcome_message', 'thinking_message', 'error_message', 'timeout_error_message',
+    'confirmation_thanks_message', 'edit_callback_answer', 'edit_prompt_message'
+)
+ORDER_FIELDS = ('arrival_time', 'duration_hours', 'hookahs_count', 'hookah_masters_count', 'location', 'phone_number')
+
+_translations.update({
+    (lang, key): i18n.gettext(key, locale=lang) for lang in LANGUAGES for key in I18N_KEYS
+})
+
+LANG_KEYBOARD = InlineKeyboardMarkup(row_width=3).add(
+    InlineKeyboardButton("🇷🇺 Русский", callback_data="lang_ru"),
+    InlineKeyboardButton("🇬🇧 English", callback_data="lang_en"),
+    InlineKeyboardButton("🇵🇱 Polski", callback_data="lang_pl")
+)
+
+def _build_confirm_keyboard(locale: str) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup(row_width=2).add(
+        InlineKeyboardButton(f"✅ {i18n.gettext('button_confirm', locale=locale)}", callback_data="confirm_order"),
+        InlineKeyboardButton(f"✏️ {i18n.gettext('button_edit', locale=locale)}", callback_data="edit_order")
+    )
+
+def _build_summary_template(locale: str) -> str:
+    label = lambda key: html.escape(i18n.gettext(key, locale=locale))
+    return (
+        f"🔍 <b>{label('summary_title')}</b>\n\n"
+        f"<b>{label('summary_when')}:</b> {{arrival_time}}\n"
+        f"<b>{label('summary_duration')}:</b> {{duration_hours}} ч.\n"
+        f"<b>{label('summary_hookahs')}:</b> {{hookahs_count}} шт.\n"
+        f"<b>{label('summary_masters')}:</b> {{hookah_masters_count}} чел.\n"
+        f"<b>{label('summary_where')}:</b> {{location}}\n"
+        f"<b>{label('summary_phone')}:</b> {{phone_number}}\n\n"
+        f"<b>{label('summary_client')}:</b> {{user_link}}"
+    )
 
+ADMIN_TEMPLATE = (
+    "📩 <b>Новый заказ!</b>\n\n"
+    "Когда: {arrival_time}\n"
+    "На сколько: {duration_hours} ч.\n"
+    "Кальяны: {hookahs_count} шт.\n"
+    "Мастера: {hookah_masters_count} чел.\n"
+    "Куда: {location}\n"
+    "Телефон: {phone_number}\n\n"
+    "Клиент: {user_link}"
+)
+
+CONFIRM_KEYBOARDS = {lang: _build_confirm_keyboard(lang) for lang in LANGUAGES}
+SUMMARY_TEMPLATES = {lang: _build_summary_template(lang) for lang in LANGUAGES}
+
+def order_values(order_details: dict, user_link: str) -> dict:
+    # Значения приходят от модели/пользователя — экранируем для parse_mode="HTML"
+    values = {field: html.escape(str(order_details.get(field))) for field in ORDER_FIELDS}
+    values['user_link'] = html.escape(user_link)
+    return values
+
+def current_locale() -> str:
+    locale = i18n.ctx_locale.get()
+    return locale if locale in LANGUAGES else i18n.default
+
+# --- Клиент Groq и AI ---
+GROQ_TIMEOUT = 20
+# Общий пул соединений с keep-alive, чтобы не платить за TCP+TLS на каждый запрос
+http_client = httpx.AsyncClient(
+    limits=httpx.Limits(max_connections=100, max_keepalive_connections=50),
+    timeout=httpx.Timeout(GROQ_TIMEOUT, connect=3.0),
+    http2=True
+)
+# Ретраи SDK отключены: политикой повторов (и таймаутом каждой попытки) управляет open_completion_stream
+client = AsyncGroq(api_key=GROQ_API_KEY, http_client=http_client, max_retries=0)
+GROQ_MAX_ATTEMPTS = 8
+GROQ_MAX_BACKOFF = 30
+# Не чаще одного редактирования сообщения за интервал — лимит Telegram на чат
+STREAM_EDIT_INTERVAL = 0.7
+MAX_TURNS = 8
+PROMPT_TOKENS_BUDGET = 4500
+
+def trim_history(history: list, prompt_tokens: int = 0) -> list:
+    """Оставляет системный промпт и последние MAX_TURNS ходов диалога.
+
+    Если Groq сообщил, что промпт превысил бюджет токенов, дополнительно
+    выбрасывает самые старые сообщения (кроме системного).
+    """
+    if len(history) > MAX_TURNS * 2 + 1:
+        history = [history[0]] + history[-MAX_TURNS * 2:]
+    while prompt_tokens > PROMPT_TOKENS_BUDGET and len(history) > 2:
+        removed = history.pop(1)
+        prompt_tokens -= len(removed.get("content") or "") // 4
+    return history
+
+LANG_NAMES = {'ru': 'русском', 'en': 'английском', 'pl': 'польском'}
+LANG_REMINDERS = {
+    'ru': '(Напоминание: отвечай только на русском языке)',
+    'en': '(Reminder: reply in English only)',
+    'pl': '(Przypomnienie: odpowiadaj tylko po polsku)'
+}
+
+@lru_cache(maxsize=8)
 def get_system_prompt(lang_code: str) -> str:
-    lang_map = {'ru': 'русском', 'en': 'английском', 'pl': 'польском'}
-    language_name = lang_map.get(lang_code, 'русском')
+    language_name = LANG_NAMES.get(lang_code, 'русском')
     
     return f"""
 Ты — "Smoky", дружелюбный и профессиональный AI-ассистент сервиса кальянного кейтеринга.
@@ -96,19 +248,228 @@ TOOLS = [
     }
 ]
 
+class AsyncTokenBucket:
+    """Ограничитель запросов к Groq по RPM и TPM.
+
+    Корутины ждут в acquire(), пока в обоих ведрах не появится емкость.
+    После ответа refund_actual() корректирует оценку по реальному usage.
+    """
+
+    def __init__(self, rpm: int, tpm: int):
+        self.rpm = rpm
+        self.tpm = tpm
+        self._requests = float(rpm)
+        self._tokens = float(tpm)
+        self._updated_at = time.monotonic()
+        self._cond = asyncio.Condition()
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self._updated_at
+        self._updated_at = now
+        self._requests = min(self.rpm, self._requests + elapsed * self.rpm / 60)
+        self._tokens = min(self.tpm, self._tokens + elapsed * self.tpm / 60)
+
+    async def acquire(self, est_tokens: int) -> int:
+        est_tokens = min(est_tokens, self.tpm)
+        async with self._cond:
+            while True:
+                self._refill()
+                if self._requests >= 1 and self._tokens >= est_tokens:
+                    self._requests -= 1
+                    self._tokens -= est_tokens
+                    return est_tokens
+                delay = max(
+                    (1 - self._requests) * 60 / self.rpm,
+                    (est_tokens - self._tokens) * 60 / self.tpm
+                )
+                try:
+                    await asyncio.wait_for(self._cond.wait(), timeout=delay)
+                except asyncio.TimeoutError:
+                    pass
+
+    def refund_nowait(self, est_tokens: int, actual_tokens: int):
+        """Корректирует оценку без ожидания; ждущие увидят емкость при следующей проверке."""
+        self._refill()
+        self._tokens = min(self.tpm, self._tokens + est_tokens - actual_tokens)
+
+    async def refund_actual(self, est_tokens: int, actual_tokens: int):
+        async with self._cond:
+            self.refund_nowait(est_tokens, actual_tokens)
+            self._cond.notify_all()
+
+
+# Квота Groq общая на организацию, поэтому ограничитель один на процесс
+groq_limiter = AsyncTokenBucket(rpm=30, tpm=6000)
+
+def estimate_tokens(messages: list) -> int:
+    return sum(len(m.get("content") or "") // 4 for m in messages) + 256
+
+async def open_completion_stream(messages: list):
+    """Открывает потоковый запрос к Groq с экспоненциальной задержкой при 429 (RateLimitError)."""
+    for attempt in range(GROQ_MAX_ATTEMPTS):
+        est_tokens = await groq_limiter.acquire(estimate_tokens(messages))
+        try:
+            stream = await asyncio.wait_for(
+                client.chat.completions.create(
+                    model="llama3-70b-8192",
+                    messages=messages,
+                    tools=TOOLS,
+                    tool_choice="auto",
+                    stream=True
+                ),
+                timeout=GROQ_TIMEOUT
+            )
+            return stream, est_tokens
+        except RateLimitError as e:
+            # Отклоненный запрос не расходует квоту токенов — возвращаем оценку
+            await groq_limiter.refund_actual(est_tokens, 0)
+            if attempt == GROQ_MAX_ATTEMPTS - 1:
+                raise
+            retry_after = e.response.headers.get("retry-after", 2 ** attempt)
+            delay = min(float(retry_after), GROQ_MAX_BACKOFF) + random.random()
+            logging.warning(f"Groq rate limit hit, retrying in {delay:.1f}s (attempt {attempt + 1}).")
+            await asyncio.sleep(delay)
+        except BaseException:
+            # Без await, чтобы возврат не потерялся при отмене (CancelledError)
+            groq_limiter.refund_nowait(est_tokens, 0)
+            raise
+
+async def _read_stream(stream, on_text=None):
+    content = ""
+    tool_calls = {}
+    usage = None
+    last_edit = 0.0
+    # Таймаут считается только по времени чтения потока; правки сообщения в Telegram в него не входят
+    read_budget = GROQ_TIMEOUT
+    chunks = stream.__aiter__()
+    while True:
+        started = time.monotonic()
+        try:
+            chunk = await asyncio.wait_for(chunks.__anext__(), timeout=read_budget)
+        except StopAsyncIteration:
+            break
+        read_budget -= time.monotonic() - started
+        x_groq = getattr(chunk, "x_groq", None)
+        if x_groq and x_groq.usage:
+            usage = x_groq.usage
+        if not chunk.choices:
+            continue
+        delta = chunk.choices[0].delta
+        # Вызовы функций приходят фрагментами — склеиваем их по индексу
+        for fragment in delta.tool_calls or []:
+            call = tool_calls.setdefault(fragment.index, {
+                "id": "", "type": "function", "function": {"name": "", "arguments": ""}
+            })
+            if fragment.id:
+                call["id"] = fragment.id
+            if fragment.function:
+                call["function"]["name"] += fragment.function.name or ""
+                call["function"]["arguments"] += fragment.function.arguments or ""
+        if delta.content:
+            content += delta.content
+            if on_text and time.monotonic() - last_edit > STREAM_EDIT_INTERVAL:
+                await on_text(content)
+                last_edit = time.monotonic()
+    return content, [tool_calls[index] for index in sorted(tool_calls)], usage
+
+async def stream_completion(messages: list, on_text=None):
+    """Получает ответ Groq потоком, вызывая on_text с накопленным текстом.
+
+    Возвращает (текст, вызовы функций, usage).
+    """
+    stream, est_tokens = await open_completion_stream(messages)
+    try:
+        content, tool_calls, usage = await _read_stream(stream, on_text)
+    except BaseException:
+        groq_limiter.refund_nowait(est_tokens, 0)
+        raise
+    finally:
+        # Возвращаем соединение в общий пул даже при таймауте или ошибке
+        await stream.close()
+    if usage:
+        await groq_limiter.refund_actual(est_tokens, usage.total_tokens)
+    return content, tool_calls, usage
+
+# Одинаковые стартовые запросы (например, «Привет») от разных пользователей
+# склеиваются в один вызов Groq. Только для коротких историй, где промпт детерминирован.
+COALESCE_MAX_MESSAGES = 2
+inflight: dict[str, asyncio.Future] = {}
+
+async def coalesced_completion(messages: list, on_text=None):
+    """Как stream_completion, но разделяет результат между одинаковыми запросами.
+
+    Поток частичного текста получает только первый запрос, остальные ждут итог.
+    """
+    if len(messages) > COALESCE_MAX_MESSAGES:
+        return await stream_completion(messages, on_text)
+
+    key = hashlib.blake2b(orjson.dumps(messages, option=orjson.OPT_SORT_KEYS), digest_size=16).hexdigest()
+    future = inflight.get(key)
+    if future is not None:
+        return await asyncio.shield(future)
+
+    future = asyncio.get_running_loop().create_future()
+    inflight[key] = future
+    try:
+        result = await stream_completion(messages, on_text)
+        future.set_result(result)
+        return result
+    except asyncio.CancelledError:
+        # Ожидающие не должны получить CancelledError — отдаем им обычную ошибку
+        future.set_exception(RuntimeError("Shared Groq request was cancelled"))
+        future.exception()
+        raise
+    except Exception as e:
+        future.set_exception(e)
+        # Помечаем исключение как полученное, даже если ожидающих не было
+        future.exception()
+        raise
+    finally:
+        del inflight[key]
+
+# --- Блокировки по чатам ---
+# Сериализуют чтение-изменение-запись истории в FSM внутри одного чата,
+# чтобы быстрые повторные сообщения не затирали друг друга.
+# Запись удаляется, только когда замок никто не держит и никто не ждет
+chat_locks: dict[int, asyncio.Lock] = {}
+chat_lock_users: dict[int, int] = {}
+
+@asynccontextmanager
+async def chat_lock(chat_id: int):
+    lock = chat_locks.setdefault(chat_id, asyncio.Lock())
+    chat_lock_users[chat_id] = chat_lock_users.get(chat_id, 0) + 1
+    try:
+        async with lock:
+            yield
+    finally:
+        chat_lock_users[chat_id] -= 1
+        if not chat_lock_users[chat_id]:
+            del chat_lock_users[chat_id]
+            del chat_locks[chat_id]
+
+# --- Фоновые задачи ---
+# Держим ссылки на задачи, иначе сборщик мусора может уничтожить их до завершения
+background_tasks: set[asyncio.Task] = set()
+
+def _log_background_error(task: asyncio.Task):
+    if not task.cancelled() and task.exception() is not None:
+        logging.error(f"Error in background task: {task.exception()}")
+
+def run_in_background(coro) -> asyncio.Task:
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    task.add_done_callback(_log_background_error)
+    return task
+
 # --- Обработчики команд ---
 @dp.message_handler(commands=['start'], state='*')
 async def cmd_start(message: types.Message, state: FSMContext):
     await state.finish()
-    keyboard = InlineKeyboardMarkup(row_width=3)
-    keyboard.add(
-        InlineKeyboardButton("🇷🇺 Русский", callback_data="lang_ru"),
-        InlineKeyboardButton("🇬🇧 English", callback_data="lang_en"),
-        InlineKeyboardButton("🇵🇱 Polski", callback_data="lang_pl")
-    )
     await message.answer(
         "Please choose your language / Пожалуйста, выберите язык / Proszę wybrać język:",
-        reply_markup=keyboard
+        reply_markup=LANG_KEYBOARD
     )
     await Conversation.waiting_for_language.set()
 
@@ -142,101 +503,97 @@ async def process_language_callback(callback: types.CallbackQuery, state: FSMCon
 # --- Основной обработчик диалога ---
 @dp.message_handler(state=Conversation.active)
 async def handle_conversation(message: types.Message, state: FSMContext):
-    user_data = await state.get_data()
-    history = user_data.get("history", [])
-    lang = user_data.get("lang", "ru")
-
-    lang_reminders = {
-        'ru': '(Напоминание: отвечай только на русском языке)',
-        'en': '(Reminder: reply in English only)',
-        'pl': '(Przypomnienie: odpowiadaj tylko po polsku)'
-    }
-    user_message_with_reminder = f"{message.text} {lang_reminders.get(lang, '')}"
-    history.append({"role": "user", "content": user_message_with_reminder})
-
-    thinking_message = await message.answer(_("thinking_message"))
-
-    try:
-        response = client.chat.completions.create(
-            model="llama3-70b-8192",
-            messages=history,
-            tools=TOOLS,
-            tool_choice="auto"
-        )
-        response_message = response.choices[0].message
-
-        tool_calls = response_message.tool_calls
-        if tool_calls:
-            await handle_tool_call(message, state, tool_calls[0])
-            await bot.delete_message(chat_id=message.chat.id, message_id=thinking_message.message_id)
-        else:
-            ai_response_text = response_message.content
-            history.append({"role": "assistant", "content": ai_response_text})
-            await state.update_data(history=history)
-            await bot.edit_message_text(ai_response_text, chat_id=message.chat.id, message_id=thinking_message.message_id)
-
-    except asyncio.TimeoutError:
-        logging.warning("Groq API request timed out.")
-        await bot.edit_message_text(_("timeout_error_message"), chat_id=message.chat.id, message_id=thinking_message.message_id)
-        history.pop()
-        await state.update_data(history=history)
-    except Exception as e:
-        logging.error(f"Error during AI conversation: {e}")
-        await bot.edit_message_text(_("error_message"), chat_id=message.chat.id, message_id=thinking_message.message_id)
-        history.pop()
-        await state.update_data(history=history)
-
-
-async def handle_tool_call(message: types.Message, state: FSMContext, tool_call):
-    if tool_call.function.name == "create_hookah_order":
-        arguments = json.loads(tool_call.function.arguments)
-        await state.update_data(order_details=arguments)
+    async with chat_lock(message.chat.id), state.proxy() as data:
+        history = list(data.get("history", []))
+        lang = data.get("lang", "ru")
+
+        history.append({"role": "user", "content": message.text})
+        history = trim_history(history)
+        # Напоминание о языке уходит только в запрос, в сохраненную историю не попадает
+        api_messages = history[:-1] + [
+            {"role": "user", "content": f"{message.text} {LANG_REMINDERS.get(lang, '')}"}
+        ]
+
+        thinking_message = await message.answer(_("thinking_message"))
+
+        try:
+            shown_text = ""
+
+            async def show_partial(text: str):
+                nonlocal shown_text
+                try:
+                    await bot.edit_message_text(text, chat_id=message.chat.id, message_id=thinking_message.message_id)
+                    shown_text = text
+                except Exception as e:
+                    logging.warning(f"Failed to show partial response: {e}")
+
+            ai_response_text, tool_calls, usage = await coalesced_completion(api_messages, on_text=show_partial)
+            if usage:
+                history = trim_history(history, usage.prompt_tokens)
+
+            if tool_calls:
+                await handle_tool_call(message, data, tool_calls[0])
+                # Реплику, завершившую заказ, в историю не сохраняем
+                data["history"] = history[:-1]
+                run_in_background(bot.delete_message(chat_id=message.chat.id, message_id=thinking_message.message_id))
+            else:
+                history.append({"role": "assistant", "content": ai_response_text})
+                data["history"] = history
+                if ai_response_text != shown_text:
+                    await bot.edit_message_text(ai_response_text, chat_id=message.chat.id, message_id=thinking_message.message_id)
+
+        except asyncio.TimeoutError:
+            logging.warning("Groq API request timed out.")
+            await bot.edit_message_text(_("timeout_error_message"), chat_id=message.chat.id, message_id=thinking_message.message_id)
+            history.pop()
+            data["history"] = history
+        except Exception as e:
+            logging.error(f"Error during AI conversation: {e}")
+            await bot.edit_message_text(_("error_message"), chat_id=message.chat.id, message_id=thinking_message.message_id)
+            history.pop()
+            data["history"] = history
+
+
+
+async def handle_tool_call(message: types.Message, data: FSMContextProxy, tool_call):
+    if tool_call["function"]["name"] == "create_hookah_order":
+        arguments = orjson.loads(tool_call["function"]["arguments"])
+        data["order_details"] = arguments
 
         user_link = f"@{message.from_user.username}" if message.from_user.username else f"tg://user?id={message.from_user.id}"
         
-        summary = (
-            f"🔍 **{_('summary_title')}**\n\n"
-            f"**{_('summary_when')}:** {arguments.get('arrival_time')}\n"
-            f"**{_('summary_duration')}:** {arguments.get('duration_hours')} ч.\n"
-            f"**{_('summary_hookahs')}:** {arguments.get('hookahs_count')} шт.\n"
-            f"**{_('summary_masters')}:** {arguments.get('hookah_masters_count')} чел.\n"
-            f"**{_('summary_where')}:** {arguments.get('location')}\n"
-            f"**{_('summary_phone')}:** {arguments.get('phone_number')}\n\n"
-            f"**{_('summary_client')}:** {user_link}"
-        )
-
-        keyboard = InlineKeyboardMarkup(row_width=2)
-        keyboard.add(
-            InlineKeyboardButton(f"✅ {_('button_confirm')}", callback_data="confirm_order"),
-            InlineKeyboardButton(f"✏️ {_('button_edit')}", callback_data="edit_order")
+        locale = current_locale()
+        summary = SUMMARY_TEMPLATES[locale].format_map(order_values(arguments, user_link))
+
+        await message.answer(
+            summary,
+            reply_markup=CONFIRM_KEYBOARDS[locale],
+            parse_mode="HTML",
+            disable_web_page_preview=True
         )
-
-        await message.answer(summary, reply_markup=keyboard, parse_mode="Markdown")
+        # Переключаем состояние внутри блокировки: кнопки уже видны пользователю.
+        # proxy.save() пишет состояние, только если присваивали data.state, поэтому его не перезапишет.
         await Conversation.confirmation.set()
 
 # --- Обработчики кнопок подтверждения ---
 @dp.callback_query_handler(lambda c: c.data == 'confirm_order', state=Conversation.confirmation)
 async def process_confirm_order(callback: types.CallbackQuery, state: FSMContext):
-    user_data = await state.get_data()
-    order_details = user_data.get("order_details")
+    async with state.proxy() as data:
+        order_details = data.get("order_details")
 
     user = callback.from_user
     user_link = f"@{user.username}" if user.username else f"tg://user?id={user.id}"
-    admin_summary = (
-        f"📩 **Новый заказ!**\n\n"
-        f"Когда: {order_details.get('arrival_time')}\n"
-        f"На сколько: {order_details.get('duration_hours')} ч.\n"
-        f"Кальяны: {order_details.get('hookahs_count')} шт.\n"
-        f"Мастера: {order_details.get('hookah_masters_count')} чел.\n"
-        f"Куда: {order_details.get('location')}\n"
-        f"Телефон: {order_details.get('phone_number')}\n\n"
-        f"Клиент: {user_link}"
-    )
+    admin_summary = ADMIN_TEMPLATE.format_map(order_values(order_details, user_link))
 
-    await bot.send_message(ADMIN_ID, admin_summary, parse_mode="Markdown")
-    
-    await callback.message.edit_text(_("confirmation_thanks_message"), parse_mode="Markdown")
-    await callback.answer()
+    results = await asyncio.gather(
+        bot.send_message(ADMIN_ID, admin_summary, parse_mode="HTML", disable_web_page_preview=True),
+        callback.message.edit_text(_("confirmation_thanks_message"), parse_mode="HTML", disable_web_page_preview=True),
+        callback.answer(),
+        return_exceptions=True
+    )
+    for result in results:
+        if isinstance(result, Exception):
+            logging.error(f"Error while confirming order: {result}\n{admin_summary}")
     await state.finish()
 
 @dp.callback_query_handler(lambda c: c.data == 'edit_order', state=Conversation.confirmation)
@@ -244,16 +601,43 @@ async def process_edit_order(callback: types.CallbackQuery, state: FSMContext):
     await callback.message.edit_reply_markup()
     await callback.answer(_('edit_callback_answer'))
     
-    user_data = await state.get_data()
-    history = user_data.get("history", [])
-    history.append({
-        "role": "assistant",
-        "content": "Пользователь хочет внести изменения в заказ. Уточни, что именно нужно поменять."
-    })
-    await state.update_data(history=history)
+    async with chat_lock(callback.message.chat.id), state.proxy() as data:
+        history = list(data.get("history", []))
+        history.append({
+            "role": "assistant",
+            "content": "Пользователь хочет внести изменения в заказ. Уточни, что именно нужно поменять."
+        })
+        data["history"] = history
     
     await callback.message.answer(_('edit_prompt_message'))
     await Conversation.active.set()
 
+# --- Запуск ---
+async def on_startup(dispatcher: Dispatcher):
+    if REDIS_HOST:
+        # Без общего хранилища воркеры разойдутся по состоянию — не стартуем вовсе
+        redis = await dispatcher.storage.redis()
+        await redis.ping()
+    if WEBHOOK_URL:
+        # Вебхук общий для всех воркеров: регистрируем его один раз и не удаляем при остановке,
+        # чтобы рестарт одного воркера не отключал остальные и не терял очередь обновлений
+        webhook_info = await dispatcher.bot.get_webhook_info()
+        if webhook_info.url != WEBHOOK_URL:
+            await dispatcher.bot.set_webhook(WEBHOOK_URL)
+
+async def on_shutdown(dispatcher: Dispatcher):
+    await http_client.aclose()
+
 if __name__ == '__main__':
-    executor.start_polling(dp, skip_updates=True)
+    if WEBHOOK_URL:
+        executor.start_webhook(
+            dispatcher=dp,
+            webhook_path=WEBHOOK_PATH,
+            on_startup=on_startup,
+            on_shutdown=on_shutdown,
+            check_ip=True,
+            host=WEBAPP_HOST,
+            port=WEBAPP_PORT
+        )
+    else:
+        executor.start_polling(dp, skip_updates=True, on_startup=on_startup, on_shutdown=on_shutdown)